@@ -1,21 +1,170 @@
+import base64
+import binascii
+import hashlib
 import os
-import random
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import orjson
 from dotenv import load_dotenv
-from flask import Flask, abort, jsonify, request
+from flask import Flask, Response, abort, jsonify, request
+from flask.json import JSONDecoder, JSONEncoder
+from flask_compress import Compress
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
+from pydantic import BaseModel, Field, ValidationError
+from sqlalchemy import Integer, cast, delete, func, select
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.orm import raiseload
 
 load_dotenv()
 
-from models import Category, Question, setup_db
+from models import Category, Question, db, setup_db
 
 QUESTIONS_PER_PAGE = 10
+MAX_QUESTIONS_PER_PAGE = 100
+CATEGORIES_CACHE_TTL = 60
+
+# Listing endpoints select just the columns format() returns rather than
+# hydrating full Question objects
+QUESTION_COLUMNS = (
+    Question.id,
+    Question.question,
+    Question.answer,
+    Question.category,
+    Question.difficulty,
+)
+
+# A counting request briefly uses two connections, one for its page query
+# and one for its background COUNT. The request thread releases its
+# connection before waiting on the COUNT, so a full pool only queues
+# checkouts and cannot deadlock. pool_size + max_overflow allows 15 counting
+# requests to overlap both queries at once. Connections are pinged on
+# checkout so ones dropped by Postgres are replaced
+SQLALCHEMY_ENGINE_OPTIONS = {
+    "pool_size": 10,
+    "max_overflow": 20,
+    "pool_timeout": 30,
+    "pool_recycle": 3600,
+    "pool_pre_ping": True,
+}
+
+# Validation errors meaning the body itself is malformed or incomplete, as
+# opposed to well-formed but holding unusable values
+BAD_REQUEST_ERRORS = {"json_invalid", "missing", "model_type"}
+
+# Categories rarely change, so keep the serialized dict in-process
+_CATEGORIES_CACHE = {"entry": None, "ts": 0}
+
+
+class QuestionCreate(BaseModel):
+    """Request body for creating a question."""
+
+    question: str
+    answer: str
+    category: int
+    difficulty: int = Field(ge=1, le=5)
+
+
+def format_question_row(row):
+    """Format a QUESTION_COLUMNS row the same way as Question.format()."""
+    return {
+        "id": row.id,
+        "question": row.question,
+        "answer": row.answer,
+        "category": row.category,
+        "difficulty": row.difficulty,
+    }
+
+
+def count_questions(app):
+    """Count all questions from a worker thread.
+
+    The worker pushes its own app context, so it gets its own scoped
+    session and pooled connection, letting the COUNT run alongside the
+    page query on the request thread.
+    """
+    with app.app_context():
+        return Question.query.with_entities(func.count(Question.id)).scalar()
+
+
+def encode_cursor(question_id):
+    """Encode a question id as an opaque pagination cursor."""
+    return base64.urlsafe_b64encode(str(question_id).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Decode a pagination cursor back into a question id, aborting on junk."""
+    if cursor is None:
+        return 0
+
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (binascii.Error, UnicodeError, ValueError):
+        abort(400)
+
+
+def _get_categories():
+    """Return the cached ({id: type} dict, ETag) pair, re-querying if stale."""
+    if time.time() - _CATEGORIES_CACHE["ts"] < CATEGORIES_CACHE_TTL:
+        return _CATEGORIES_CACHE["entry"]
+
+    # Plain (id, type) rows are all the dict needs, so skip the ORM objects
+    rows = db.session.execute(
+        select(Category.id, Category.type).order_by(Category.id)
+    ).all()
+    categories_dict = dict(rows)
+    etag = hashlib.sha1(
+        orjson.dumps(
+            categories_dict,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS,
+        )
+    ).hexdigest()
+
+    # Publish the dict and its ETag in one assignment so no reader can pair
+    # a new dict with an old ETag or vice versa
+    entry = (categories_dict, etag)
+    _CATEGORIES_CACHE["entry"] = entry
+    _CATEGORIES_CACHE["ts"] = time.time()
+
+    return entry
+
+
+def invalidate_categories_cache():
+    """Force the next categories lookup to hit the database."""
+    _CATEGORIES_CACHE["ts"] = 0
+
+
+class ORJSONEncoder(JSONEncoder):
+    """JSON encoder that serializes with orjson instead of the stdlib."""
+
+    def encode(self, o):
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if self.indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(o, default=self.default, option=option).decode()
+
+
+class ORJSONDecoder(JSONDecoder):
+    """JSON decoder that parses request bodies with orjson."""
+
+    def decode(self, s):
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError as e:
+            raise ValueError(str(e)) from e
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
+    app.json_encoder = ORJSONEncoder
+    app.json_decoder = ORJSONDecoder
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = SQLALCHEMY_ENGINE_OPTIONS
+    app.config["COMPRESS_ALGORITHM"] = ["br", "gzip"]
+    app.config["COMPRESS_MIN_SIZE"] = 500
 
     if test_config is None:
         # load the instance config, if it exists, when not testing
@@ -31,6 +180,9 @@ def create_app(test_config=None):
         database_path = test_config.get("SQLALCHEMY_DATABASE_URI")
         setup_db(app, database_path=database_path)
 
+    # Compress JSON responses for clients that accept br or gzip
+    Compress(app)
+
     """
     @DONE: Use the after_request decorator to set Access-Control-Allow
     """
@@ -51,15 +203,29 @@ def create_app(test_config=None):
 
     @app.route("/categories", methods=["GET"])
     def get_categories():
-        categories = Category.query.order_by(Category.id).all()
-        categories_dict = {
-            category.id: category.type for category in categories
-        }
+        categories_dict, etag = _get_categories()
 
         if len(categories_dict) == 0:
             abort(404)
 
-        return jsonify({"success": True, "categories": categories_dict})
+        # Answer revalidation requests without re-encoding the categories.
+        # If-None-Match uses weak comparison, so a W/ tag from a proxy
+        # matches. Flask-Compress appends the algorithm to the ETag of any
+        # response it compresses, so also accept "<etag>:br" and
+        # "<etag>:gzip", echoing back whichever validator the client sent
+        validators = [etag] + [
+            f"{etag}:{algorithm}"
+            for algorithm in app.config["COMPRESS_ALGORITHM"]
+        ]
+        for validator in validators:
+            if request.if_none_match.contains_weak(validator):
+                response = Response(status=304)
+                response.set_etag(validator)
+                return response
+
+        response = jsonify({"success": True, "categories": categories_dict})
+        response.set_etag(etag)
+        return response
 
     """
     @DONE: 
@@ -77,36 +243,107 @@ def create_app(test_config=None):
 
     @app.route("/questions", methods=["GET"])
     def get_questions():
-        PAGE_SIZE = 10
+        # Requests using ?page= keep the original offset pagination so
+        # existing clients still receive total_questions for their pager
+        if "page" in request.args:
+            return get_questions_by_page()
 
+        limit = request.args.get("limit", QUESTIONS_PER_PAGE, type=int)
+        if limit < 1:
+            abort(400)
+        limit = min(limit, MAX_QUESTIONS_PER_PAGE)
+
+        after = decode_cursor(request.args.get("after"))
+        include_total = request.args.get("include_total", 0, type=int)
+
+        # A short-lived executor per request keeps one request's COUNT from
+        # queueing behind another's
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            if include_total:
+                future_total = executor.submit(count_questions, app)
+
+            # Seek past the cursor using the primary key index; fetching one
+            # extra row tells us whether there is a next page without a COUNT
+            questions = (
+                Question.query.with_entities(*QUESTION_COLUMNS)
+                .filter(Question.id > after)
+                .order_by(Question.id)
+                .limit(limit + 1)
+                .all()
+            )
+
+            # Hand the connection back before waiting on the COUNT, so
+            # request threads never hold one while queueing for another
+            if include_total:
+                db.session.close()
+
+        has_more = len(questions) > limit
+        questions = questions[:limit]
+
+        # If no questions found after the cursor, return 404
+        if not questions:
+            abort(404)
+
+        # Format questions
+        formatted_questions = [format_question_row(row) for row in questions]
+
+        # Get all categories
+        categories_dict, _ = _get_categories()
+
+        response = {
+            "success": True,
+            "questions": formatted_questions,
+            "next_cursor": (
+                encode_cursor(questions[-1].id) if has_more else None
+            ),
+            "has_more": has_more,
+            "categories": categories_dict,
+            "current_category": None,
+        }
+
+        if include_total:
+            response["total_questions"] = future_total.result()
+
+        return jsonify(response)
+
+    def get_questions_by_page():
         # Get page from query parameters, default to 1
         page = request.args.get("page", 1, type=int)
 
-        # Get all questions, paginated
-        questions = Question.query.order_by(Question.id).paginate(
-            page=page, per_page=PAGE_SIZE, error_out=False
-        )
+        page = max(page, 1)
+
+        # Count in the background while this thread fetches the page
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future_total = executor.submit(count_questions, app)
+
+            questions = (
+                Question.query.with_entities(*QUESTION_COLUMNS)
+                .order_by(Question.id)
+                .limit(QUESTIONS_PER_PAGE)
+                .offset((page - 1) * QUESTIONS_PER_PAGE)
+                .all()
+            )
+
+            # Hand the connection back before waiting on the COUNT, so
+            # request threads never hold one while queueing for another
+            db.session.close()
+            total_questions = future_total.result()
 
         # If no questions found for the requested page, return 404
-        if not questions.items:
+        if not questions:
             abort(404)
 
         # Format questions
-        formatted_questions = [
-            question.format() for question in questions.items
-        ]
+        formatted_questions = [format_question_row(row) for row in questions]
 
         # Get all categories
-        categories = Category.query.order_by(Category.id).all()
-        categories_dict = {
-            category.id: category.type for category in categories
-        }
+        categories_dict, _ = _get_categories()
 
         return jsonify(
             {
                 "success": True,
                 "questions": formatted_questions,
-                "total_questions": questions.total,
+                "total_questions": total_questions,
                 "categories": categories_dict,
                 "current_category": None,
             }
@@ -122,17 +359,24 @@ def create_app(test_config=None):
 
     @app.route("/questions/<int:question_id>", methods=["DELETE"])
     def delete_question(question_id):
-        question = Question.query.get(question_id)
-        if question is None:
-            abort(404)
-
+        # Delete in a single statement rather than loading the row first
         try:
-            question.delete()
-
-            return jsonify({"success": True, "deleted": question_id})
+            result = db.session.execute(
+                delete(Question)
+                .where(Question.id == question_id)
+                .returning(Question.id)
+            )
+            deleted_id = result.scalar()
+            db.session.commit()
         except:
+            db.session.rollback()
             abort(422)
 
+        if deleted_id is None:
+            abort(404)
+
+        return jsonify({"success": True, "deleted": deleted_id})
+
     """
     @DONE:
     Create an endpoint to POST a new question,
@@ -146,30 +390,27 @@ def create_app(test_config=None):
 
     @app.route("/questions", methods=["POST"])
     def create_question():
-        data = request.get_json()
-
-        # Check if all required fields are present
-        required_fields = ["question", "answer", "category", "difficulty"]
-        if not all(field in data for field in required_fields):
-            abort(400)
+        # Validate the body before touching the database: missing fields
+        # are a bad request, values of the wrong type are unprocessable
+        try:
+            data = QuestionCreate.model_validate_json(request.get_data())
+        except ValidationError as e:
+            error_types = {error["type"] for error in e.errors()}
+            if error_types & BAD_REQUEST_ERRORS:
+                abort(400)
+            abort(422)
 
         new_question = Question(
-            question=data["question"],
-            answer=data["answer"],
-            category=data["category"],
-            difficulty=data["difficulty"],
+            question=data.question,
+            answer=data.answer,
+            category=data.category,
+            difficulty=data.difficulty,
         )
 
         try:
             new_question.insert()
             return (
-                jsonify(
-                    {
-                        "success": True,
-                        "created": new_question.id,
-                        "total_questions": Question.query.count(),
-                    }
-                ),
+                jsonify({"success": True, "created": new_question.id}),
                 201,
             )
         except:
@@ -195,12 +436,15 @@ def create_app(test_config=None):
         if not search_term:
             abort(400)
 
-        # Perform case-insensitive search
-        questions = Question.query.filter(
-            Question.question.ilike(f"%{search_term}%")
-        ).all()
+        # Perform case-insensitive search, backed by the idx_question_trgm
+        # trigram index for terms of three or more characters
+        questions = (
+            Question.query.with_entities(*QUESTION_COLUMNS)
+            .filter(Question.question.ilike(f"%{search_term}%"))
+            .all()
+        )
 
-        formatted_questions = [question.format() for question in questions]
+        formatted_questions = [format_question_row(row) for row in questions]
 
         return jsonify(
             {
@@ -223,35 +467,31 @@ def create_app(test_config=None):
     @app.route("/categories/<int:category_id>/questions")
     def get_questions_by_category(category_id):
 
-        # Get questions for the specified category
-        questions = Question.query.filter(
-            Question.category == str(category_id)
-        ).all()
+        # Get questions for the specified category along with its type
+        # in a single round-trip
+        rows = (
+            db.session.query(*QUESTION_COLUMNS, Category.type)
+            .join(Category, Category.id == Question.category)
+            .filter(Category.id == category_id)
+            .order_by(Question.id)
+            .all()
+        )
 
         # If no questions found for the category, return 404
-
-        if len(questions) == 0:
+        if len(rows) == 0:
             abort(404)
 
-        try:
-            # Format the questions
-            formatted_questions = [question.format() for question in questions]
-
-            # Get the category
-            category = Category.query.get(category_id)
-            if not category:
-                abort(404)
-
-            return jsonify(
-                {
-                    "success": True,
-                    "questions": formatted_questions,
-                    "total_questions": len(formatted_questions),
-                    "current_category": category.type,
-                }
-            )
-        except:
-            abort(500)
+        # Format the questions
+        formatted_questions = [format_question_row(row) for row in rows]
+
+        return jsonify(
+            {
+                "success": True,
+                "questions": formatted_questions,
+                "total_questions": len(formatted_questions),
+                "current_category": rows[0].type,
+            }
+        )
 
     """
     @DONE:
@@ -271,27 +511,34 @@ def create_app(test_config=None):
             body = request.get_json()
             previous_questions = body.get("previous_questions", [])
             quiz_category = body.get("quiz_category")
+            # Bind previous questions as a single array parameter, so
+            # SQLAlchemy compiles the same statement however long the quiz
+            # runs and Postgres checks ids against a hashed subplan rather
+            # than a growing IN list
+            previous_ids = select(
+                func.unnest(cast(previous_questions, ARRAY(Integer)))
+            )
+            # raiseload("*") makes any relationship format() touches fail
+            # loudly instead of lazy loading. Relationships format() needs
+            # should be loaded with selectinload().
+            quiz_questions = Question.query.options(raiseload("*")).filter(
+                Question.id.notin_(previous_ids)
+            )
 
             if quiz_category:
                 category_id = quiz_category.get("id")
-                if category_id == 0:  # "All" category
-                    available_questions = Question.query.filter(
-                        ~Question.id.in_(previous_questions)
-                    ).all()
-                else:
-                    available_questions = Question.query.filter(
-                        Question.category == str(category_id),
-                        ~Question.id.in_(previous_questions),
-                    ).all()
-            else:
-                available_questions = Question.query.filter(
-                    ~Question.id.in_(previous_questions)
-                ).all()
-
-            if not available_questions:
+                if category_id != 0:  # 0 is the "All" category
+                    quiz_questions = quiz_questions.filter(
+                        Question.category == category_id
+                    )
+
+            # Let Postgres pick the random row with a top-1 heapsort, so a
+            # single round trip returns only the chosen question
+            random_question = quiz_questions.order_by(func.random()).first()
+
+            if random_question is None:
                 return jsonify({"success": True, "question": None})
 
-            random_question = random.choice(available_questions)
             formatted_question = random_question.format()
 
             return jsonify({"success": True, "question": formatted_question})
@@ -304,14 +551,6 @@ def create_app(test_config=None):
     Create error handlers for all expected errors including 404 and 422.
     """
 
-    def create_error_response(error_code, message):
-        return (
-            jsonify(
-                {"success": False, "error": error_code, "message": message}
-            ),
-            error_code,
-        )
-
     error_messages = {
         400: "Bad request",
         404: "Resource not found",
@@ -319,11 +558,25 @@ def create_app(test_config=None):
         500: "Internal server error",
     }
 
-    for error_code, message in error_messages.items():
+    # Error bodies never change, so serialize them once up front
+    error_bodies = {
+        error_code: orjson.dumps(
+            {"success": False, "error": error_code, "message": message},
+            option=orjson.OPT_SORT_KEYS,
+        )
+        for error_code, message in error_messages.items()
+    }
+
+    def create_error_response(error_code):
+        return Response(
+            error_bodies[error_code],
+            status=error_code,
+            mimetype="application/json",
+        )
+
+    for error_code in error_messages:
         app.errorhandler(error_code)(
-            lambda e, code=error_code, msg=message: create_error_response(
-                code, msg
-            )
+            lambda e, code=error_code: create_error_response(code)
         )
 
     return app
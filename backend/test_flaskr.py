@@ -1,11 +1,13 @@
 import json
+import threading
 import unittest
 from os import environ
 from unittest.mock import patch
 
 from flask_sqlalchemy import SQLAlchemy
-from flaskr import create_app
-from models import Category, Question, setup_db
+from flaskr import create_app, invalidate_categories_cache
+from models import Category, Question, db, setup_db
+from sqlalchemy import event
 
 
 class TriviaTestCase(unittest.TestCase):
@@ -29,6 +31,9 @@ class TriviaTestCase(unittest.TestCase):
         self.app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
         setup_db(self.app)
 
+        # Start every test with an empty categories cache
+        invalidate_categories_cache()
+
         # Binds the app to the current context
         with self.app.app_context():
             self.db = SQLAlchemy()
@@ -51,12 +56,58 @@ class TriviaTestCase(unittest.TestCase):
 
     def test_get_categories_404(self):
         """Test 404 error for requesting categories"""
-        with patch("flaskr.Category.query") as mock_query:
-            mock_query.order_by().all.return_value = []
+        with patch("flaskr.db.session.execute") as mock_execute:
+            mock_execute.return_value.all.return_value = []
             response = self.client().get("/categories")
 
         self.assertEqual(response.status_code, 404)
 
+    def test_get_categories_cached(self):
+        """Test categories are served from the cache on repeat requests"""
+        self.client().get("/categories")
+        with patch("flaskr.db.session.execute") as mock_execute:
+            response = self.client().get("/categories")
+
+        self.assertEqual(response.status_code, 200)
+        mock_execute.assert_not_called()
+
+    def test_get_categories_304(self):
+        """Test 304 response for categories the client already has"""
+        etag = self.client().get("/categories").headers["ETag"]
+        response = self.client().get(
+            "/categories", headers={"If-None-Match": etag}
+        )
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b"")
+
+    def test_get_categories_304_weak(self):
+        """Test 304 response for a weakened categories ETag"""
+        etag = self.client().get("/categories").headers["ETag"]
+        response = self.client().get(
+            "/categories", headers={"If-None-Match": f"W/{etag}"}
+        )
+
+        self.assertEqual(response.status_code, 304)
+
+    def test_get_categories_304_compressed(self):
+        """Test 304 response for the ETag of compressed categories"""
+        # Force compression, which rewrites the ETag to "<etag>:gzip"
+        self.app.config["COMPRESS_MIN_SIZE"] = 0
+        headers = {"Accept-Encoding": "gzip"}
+        first = self.client().get("/categories", headers=headers)
+        etag = first.headers["ETag"]
+
+        self.assertEqual(first.headers["Content-Encoding"], "gzip")
+        self.assertTrue(etag.endswith(':gzip"'))
+
+        response = self.client().get(
+            "/categories", headers={**headers, "If-None-Match": etag}
+        )
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers["ETag"], etag)
+
     def test_get_questions(self):
         """Test GET request for questions"""
         response = self.client().get("/questions")
@@ -66,10 +117,120 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data["success"], True)
         self.assertTrue(data["questions"])
         self.assertTrue(len(data["questions"]) <= 10)
-        self.assertTrue(data["total_questions"])
+        self.assertIn("has_more", data)
+        self.assertIn("next_cursor", data)
+        self.assertNotIn("total_questions", data)
         self.assertTrue(data["categories"])
         self.assertIsNone(data["current_category"])
 
+    def test_get_questions_statement_count(self):
+        """Test GET request for questions does not issue N+1 queries"""
+        statements = []
+
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = db.engine
+
+        event.listen(engine, "before_cursor_execute", count_statement)
+        try:
+            response = self.client().get("/questions?include_total=1")
+        finally:
+            event.remove(engine, "before_cursor_execute", count_statement)
+
+        self.assertEqual(response.status_code, 200)
+        # SELECT + COUNT + categories
+        self.assertLessEqual(len(statements), 3)
+
+    def test_get_questions_compressed(self):
+        """Test GET request for questions is gzip encoded when accepted"""
+        response = self.client().get(
+            "/questions", headers={"Accept-Encoding": "gzip"}
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+
+    def test_get_questions_next_cursor(self):
+        """Test GET request for questions following the next cursor"""
+        response = self.client().get("/questions?limit=2")
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(data["questions"]), 2)
+        self.assertTrue(data["has_more"])
+
+        response = self.client().get(
+            f"/questions?limit=2&after={data['next_cursor']}"
+        )
+        next_data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(
+            next_data["questions"][0]["id"], data["questions"][-1]["id"]
+        )
+
+    def test_get_questions_include_total(self):
+        """Test GET request for questions with the total count opted in"""
+        response = self.client().get("/questions?include_total=1")
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(data["total_questions"])
+
+    def test_get_questions_by_page(self):
+        """Test GET request for questions using page numbers"""
+        response = self.client().get("/questions?page=1")
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertTrue(data["questions"])
+        self.assertTrue(len(data["questions"]) <= 10)
+        self.assertTrue(data["total_questions"])
+        self.assertTrue(data["categories"])
+
+    def test_get_questions_count_overlaps_page_query(self):
+        """Test the question count runs alongside the page query"""
+        page_selected = threading.Event()
+
+        def on_execute(conn, cursor, statement, *args):
+            if "FROM questions" in statement:
+                page_selected.set()
+
+        def count_after_page_query(app):
+            # Only answers once the request thread has sent its page
+            # SELECT, which never happens if the COUNT must finish first
+            if not page_selected.wait(timeout=10):
+                raise RuntimeError("page query did not run during the count")
+            return 1
+
+        with self.app.app_context():
+            engine = db.engine
+
+        event.listen(engine, "before_cursor_execute", on_execute)
+        try:
+            with patch(
+                "flaskr.count_questions", side_effect=count_after_page_query
+            ):
+                response = self.client().get("/questions?page=1")
+        finally:
+            event.remove(engine, "before_cursor_execute", on_execute)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data["total_questions"], 1)
+
+    def test_get_questions_400(self):
+        """Test 400 error for requesting questions with an invalid cursor"""
+        response = self.client().get("/questions?after=not-a-cursor")
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "Bad request")
+
     def test_get_questions_404(self):
         """Test 404 error for requesting questions beyond valid page"""
         response = self.client().get("/questions?page=1000")
@@ -104,7 +265,7 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 201)
         self.assertEqual(data["success"], True)
         self.assertTrue(data["created"])
-        self.assertTrue(data["total_questions"])
+        self.assertNotIn("total_questions", data)
 
     def test_create_question_400(self):
         """Test 400 error for creating a question with missing fields"""
@@ -139,6 +300,23 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data["success"], False)
         self.assertEqual(data["message"], "Unprocessable entity")
 
+    def test_create_question_422_difficulty(self):
+        """Test 422 error for creating a question with an invalid difficulty"""
+        response = self.client().post(
+            "/questions",
+            json={
+                "question": "What is the capital of France?",
+                "answer": "Paris",
+                "category": 1,
+                "difficulty": 9,  # Should be between 1 and 5
+            },
+        )
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "Unprocessable entity")
+
     def test_search_questions(self):
         """Test POST request for searching questions"""
         response = self.client().post(
@@ -239,7 +417,7 @@ class TriviaTestCase(unittest.TestCase):
         # Get all question ids for a category
         category_id = 1
         questions = Question.query.filter(
-            Question.category == str(category_id)
+            Question.category == category_id
         ).all()
         question_ids = [q.id for q in questions]
 